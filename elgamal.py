@@ -7,7 +7,8 @@
 
 import secrets
 from funcs import (
-    block_from_bytes, blocks_from_bytes, bytes_from_block, compute_block_size, power_mod, multiplicative_inverse
+    block_from_bytes, blocks_from_bytes, bytes_from_block, compute_block_size, multiplicative_inverse,
+    power_mod_blocks, fixed_base_power_mod
 )
 from diffie_hellman import (
     diffie_primes
@@ -29,7 +30,7 @@ def generate_public_key(p: int, g: int, ai: int) -> int:
     int
         Public key
     '''
-    return power_mod(g, ai, p)
+    return pow(g, ai, p)
 
 def elgamal_keygen(p: int, g: int) -> tuple[int, int]:
     '''
@@ -45,7 +46,7 @@ def elgamal_keygen(p: int, g: int) -> tuple[int, int]:
     tuple[int, int]
         Public and private key
     '''
-    ai = secrets.choice(range(2, p-3)) # [2, p-3), since we want [2, p-2]
+    ai = secrets.randbelow(p - 5) + 2 # [2, p-3), since we want [2, p-2]
     pb = generate_public_key(p, g, ai)
     return pb, ai
 
@@ -78,22 +79,13 @@ def elgamal_encrypt(by: bytes, g: int, k: int, pk_bob: int, p: int) -> tuple[int
     last_size = len(by) % block_size    
     last_size = last_size or block_size
     encrypted = elgamal_encrypt_aux(by, g, pk_bob, p, block_size)
-  
-    for block in encrypted:
-        encrC1.append(block[0])
-        encrC2.append(block[1].to_bytes(encrypted_block_size, 'big'))
-
     padding_block = elgamal_encrypt_aux(last_size.to_bytes(block_size, byteorder="big"), g, pk_bob, p, block_size)
-    
-    for block in padding_block:
+  
+    for block in encrypted + padding_block:
         encrC1.append(block[0])
         encrC2.append(block[1].to_bytes(encrypted_block_size, 'big'))
 
-    list = []
-    for elementC1, elementC2 in zip(encrC1, encrC2):
-        list.append((elementC1, elementC2))
-    
-    return list
+    return list(zip(encrC1, encrC2))
 
 def elgamal_encrypt_aux(by: bytes, g: int, pk_bob: int, p: int, extract_blocks_size: int) -> list[tuple[int, int]]:
     '''
@@ -115,12 +107,13 @@ def elgamal_encrypt_aux(by: bytes, g: int, pk_bob: int, p: int, extract_blocks_s
         Encrypted message list of ints values C1, C2
     '''
     blocks = blocks_from_bytes(by, extract_blocks_size)
+    keys = [secrets.randbelow(p - 5) + 2 for _ in blocks]
     encryptions = []
 
-    for block in blocks:
-        key = secrets.choice(range(2, p-3))
-        C1 = power_mod(g, key, p)
-        C2 = (block*power_mod(pk_bob, key, p))%p
+    listC1 = fixed_base_power_mod(g, keys, p)
+    shared = fixed_base_power_mod(pk_bob, keys, p)
+    for block, C1, s in zip(blocks, listC1, shared):
+        C2 = (block*s)%p
         encryptions.append((C1, C2))
 
     return encryptions
@@ -140,24 +133,21 @@ def elgamal_decrypt(by: bytes, p: int, ai: int) -> bytes:
     bytes
         Decrypted message
     '''
-    decryptedC1 = []
-    decryptedC2 = []
-    for block in by:
-        decryptedC1.append(block[0])
-        decryptedC2.append(block[1])
+    decryptedC1, decryptedC2 = zip(*by)
 
     encrypted_block_size = compute_block_size(p) + 1
 
     decrypted = elgamal_decrypt_aux(decryptedC1, decryptedC2, ai, p)
     last_size = decrypted[-1]
-    last_block = [bytes_from_block(decrypted[-2], last_size)]
-    decrypted = decrypted[:-2]
-
-    decrypted = [bytes_from_block(block, encrypted_block_size - 1) 
-                 for block in decrypted]
-    decrypted = (b'').join(decrypted + last_block)
+    decrypted_block_size = encrypted_block_size - 1
 
-    return decrypted
+    # bytes_from_block keeps blocks bigger than the block size whole, as
+    # rsa_decrypt does, so the blocks are joined instead of written at fixed
+    # offsets of a preallocated buffer
+    return b''.join([
+        *(bytes_from_block(block, decrypted_block_size) for block in decrypted[:-2]),
+        bytes_from_block(decrypted[-2], last_size)
+    ])
 
 def elgamal_decrypt_aux(listC1: list, listC2: list, ai: int, p: int) -> list[int]:
     '''
@@ -183,7 +173,8 @@ def elgamal_decrypt_aux(listC1: list, listC2: list, ai: int, p: int) -> list[int
         blocksC1.append(elementC1)
         blocksC2.append(block_from_bytes(elementC2))        
 
-    return [blockC2*multiplicative_inverse(power_mod(blockC1, ai, p), p)%p for blockC1, blockC2 in zip(blocksC1, blocksC2)]
+    shared = power_mod_blocks(blocksC1, ai, p)
+    return [blockC2*multiplicative_inverse(s, p)%p for s, blockC2 in zip(shared, blocksC2)]
 
 if __name__ == "__main__":
     # Bob's keys
@@ -5,10 +5,47 @@ Created on Tue Nov  8 12:08:58 2022
 @author: David
 """
 from typing import Iterable, Callable
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+import functools
+import itertools
 import math
+import os
 import secrets
+import warnings
 from decimal import Decimal
 
+# gmpy2 is optional. Its powmod_base_list and powmod_exp_list exponentiate a
+# whole batch of blocks in GMP with a single call and release the GIL, so
+# chunks of a batch can run in parallel threads
+try:
+    import gmpy2
+except ImportError:
+    gmpy2 = None
+
+# With gmpy2, batches of blocks up to this size are exponentiated one by one,
+# since the batched paths do not pay off for them
+_PARALLEL_THRESHOLD = 64
+_WORKERS = os.cpu_count() or 1
+
+# Without gmpy2, pow holds the GIL, so expensive batches are sent to a pool of
+# processes. The work of a batch is estimated as
+# blocks * bitlength(exp) * bitlength(m) ** 2, which costs about 4e-12 s per
+# unit with pow. Below this value (about 0.25 s) the pool startup, around
+# 65 ms with the spawn start method, does not pay off
+_PROCESS_POOL_MIN_WORK = 2 ** 36
+
+# Without gmpy2, fixed_base_power_mod only uses its table of powers for moduli
+# of at least this many bits. Smaller ones fit in a single digit of a Python
+# int, where pow is faster than the products of the table
+_FIXED_BASE_MIN_BITS = 32
+
+# Primes lower than 2000 and their product, used to discard most composite
+# candidates with a single gcd before running Miller-Rabin
+_SMALL_PRIMES = [
+    i for i in range(2, 2000) if all(i % j != 0 for j in range(2, math.isqrt(i) + 1))
+]
+_SMALL_PRIMES_PRODUCT = math.prod(_SMALL_PRIMES)
+
 
 def coprimes(a: int, b: int) -> bool:
     '''
@@ -28,44 +65,40 @@ def coprimes(a: int, b: int) -> bool:
     '''
     return math.gcd(a, b) == 1
 
-def iter_blocks(iterable: Iterable, n: int):
+def power_mod(base: int, exp: int, m: int) -> int:
     '''
-    Generator that returns blocks of size n from iterable. The last block may
-    be truncated if the length of the iterable is not divisible by n
+    Compute (base ** exp) % m
+    
+    Deprecated: use the built-in pow(base, exp, m) instead
 
     Parameters
     ----------
-    iterable : Iterable
-        An iterable
-    n : int
-        Block size.
+    base : int
+        Base
+    power : int
+        Exponent
+    m : int
+        Modulo
 
     Returns
     -------
-    A generator that produces the blocks.
-
-    '''
-    if n <= 0:
-        raise ValueError("n must be greater than 0")
-    acum = []
-    for elem in iterable:
-        acum.append(elem)
-        if len(acum) == n:
-            yield acum
-            acum = []
-    if acum:
-        yield acum
-    
+    int
+        Result
+    '''
+    warnings.warn("power_mod is deprecated, use pow", DeprecationWarning,
+                  stacklevel=2)
+    return pow(base, exp, m)
 
-def power_mod(base: int, exp: int, m: int) -> int:
+def fast_power_mod(base: int, exp: int, m: int) -> int:
     '''
-    Compute (base ** exp) % m
+    Compute (base ** exp) % m with GMP's mpz_powm through gmpy2 if it is
+    available, with pow otherwise
 
     Parameters
     ----------
     base : int
         Base
-    power : int
+    exp : int
         Exponent
     m : int
         Modulo
@@ -75,7 +108,152 @@ def power_mod(base: int, exp: int, m: int) -> int:
     int
         Result
     '''
-    return pow(base, exp, m)
+    if gmpy2 is None:
+        return pow(base, exp, m)
+    return int(gmpy2.powmod(base, exp, m))
+
+def _parallel_chunks(func: Callable[[list[int]], list], items: list[int]
+                     ) -> list[int]:
+    '''
+    Split items in one chunk per worker, apply func to every chunk in a pool
+    of threads and join the results as ints. func must release the GIL
+    '''
+    size = -(-len(items) // _WORKERS)
+    chunks = [items[i:i + size] for i in range(0, len(items), size)]
+    if len(chunks) == 1:
+        return [int(r) for r in func(chunks[0])]
+    with ThreadPoolExecutor(max_workers=len(chunks)) as executor:
+        return [int(r) for result in executor.map(func, chunks) for r in result]
+
+def power_mod_blocks(bases: Iterable[int], exp: int, m: int) -> list[int]:
+    '''
+    Compute (base ** exp) % m for every base in bases.
+    
+    See power_mod_batches for how the exponentiations are distributed.
+
+    Parameters
+    ----------
+    bases : Iterable[int]
+        Bases
+    exp : int
+        Exponent shared by all the bases
+    m : int
+        Modulo
+
+    Returns
+    -------
+    list[int]
+        Results, in the same order as bases
+    '''
+    return power_mod_batches([(bases, exp, m)])[0]
+
+def power_mod_batches(batches: Iterable[tuple[Iterable[int], int, int]]
+                      ) -> list[list[int]]:
+    '''
+    Compute (base ** exp) % m for every base of every (bases, exp, m) batch.
+    
+    If gmpy2 is available, batches of up to _PARALLEL_THRESHOLD bases are
+    exponentiated one by one with fast_power_mod and bigger ones are split
+    among the CPUs and computed with gmpy2.powmod_base_list in threads.
+    
+    Otherwise pow is used, in a single pool of processes shared by all the
+    batches if their estimated work exceeds _PROCESS_POOL_MIN_WORK and there
+    is more than one CPU, sequentially if not.
+
+    Parameters
+    ----------
+    batches : Iterable[tuple[Iterable[int], int, int]]
+        Bases, exponent shared by the bases and modulo of each batch
+
+    Returns
+    -------
+    list[list[int]]
+        Results of each batch, in the same order as the bases
+    '''
+    batches = [(list(bases), exp, m) for bases, exp, m in batches]
+    if gmpy2 is not None:
+        return [
+            [fast_power_mod(base, exp, m) for base in bases]
+            if len(bases) <= _PARALLEL_THRESHOLD
+            else _parallel_chunks(
+                lambda chunk, exp=exp, m=m: gmpy2.powmod_base_list(chunk, exp, m),
+                bases)
+            for bases, exp, m in batches
+        ]
+    
+    work = sum(len(bases) * bitlength(exp) * bitlength(m) ** 2
+               for bases, exp, m in batches)
+    if _WORKERS == 1 or work < _PROCESS_POOL_MIN_WORK:
+        return [[pow(base, exp, m) for base in bases]
+                for bases, exp, m in batches]
+    
+    with ProcessPoolExecutor() as executor:
+        # map submits every batch right away, so they all run concurrently
+        results = [
+            executor.map(pow, bases, itertools.repeat(exp), itertools.repeat(m),
+                         chunksize=max(1, len(bases) // (4 * _WORKERS)))
+            for bases, exp, m in batches
+        ]
+        return [list(result) for result in results]
+
+@functools.lru_cache(maxsize=8)
+def _fixed_base_table(base: int, m: int) -> tuple[int, ...]:
+    '''
+    Compute (base ** (2 ** i)) % m for i in range(bitlength(m))
+    '''
+    table = [base % m]
+    for _ in range(bitlength(m) - 1):
+        table.append(table[-1] * table[-1] % m)
+    return tuple(table)
+
+def fixed_base_power_mod(base: int, exps: Iterable[int], m: int) -> list[int]:
+    '''
+    Compute (base ** exp) % m for every exp in exps.
+    
+    If gmpy2 is available, batches of up to _PARALLEL_THRESHOLD exponents are
+    computed one by one with fast_power_mod and bigger ones are split among
+    the CPUs and computed with gmpy2.powmod_exp_list in threads. Otherwise
+    the powers base ** (2 ** i) are precomputed once per (base, m), so each
+    exponentiation only needs one product per active bit of the exponent
+    instead of a full square-and-multiply, except for moduli below
+    _FIXED_BASE_MIN_BITS bits, which use pow directly.
+
+    Parameters
+    ----------
+    base : int
+        Base shared by all the exponentiations
+    exps : Iterable[int]
+        Exponents
+    m : int
+        Modulo
+
+    Returns
+    -------
+    list[int]
+        Results, in the same order as exps
+    '''
+    exps = list(exps)
+    if gmpy2 is not None:
+        if len(exps) <= _PARALLEL_THRESHOLD:
+            return [fast_power_mod(base, exp, m) for exp in exps]
+        return _parallel_chunks(
+            lambda chunk: gmpy2.powmod_exp_list(base, chunk, m), exps)
+    
+    if bitlength(m) < _FIXED_BASE_MIN_BITS:
+        return [pow(base, exp, m) for exp in exps]
+    
+    table = _fixed_base_table(base, m)
+    results = []
+    for exp in exps:
+        if exp < 0 or bitlength(exp) > len(table):
+            results.append(pow(base, exp, m))
+            continue
+        result = 1 % m
+        for i, bit in enumerate(reversed(bin(exp)[2:])):
+            if bit == '1':
+                result = result * table[i] % m
+        results.append(result)
+    return results
 
 def product_mod(a: int, b: int, m:int) -> int:
     '''
@@ -115,16 +293,19 @@ def multiplicative_inverse(number: int, m: int = None) -> int:
         The multiplicative inverse of number in modulo m
 
     '''
-    return power_mod(number, -1, m)
+    return pow(number, -1, m)
 
-def blocks_from_bytes(by: bytes, block_size: int) -> list:
+def blocks_from_bytes(by: bytes | memoryview, block_size: int) -> list:
     '''
     Transform text to a list of numeric blocks, based on number of bits in the
     key in order to encrypted.
+    
+    The blocks are sliced from a memoryview of by, so no intermediate bytes
+    objects are created.
 
     Parameters
     ----------
-    by : bytes
+    by : bytes | memoryview
         Plain text
     block_size : int
         Number of bytes per block
@@ -137,8 +318,9 @@ def blocks_from_bytes(by: bytes, block_size: int) -> list:
     if block_size <= 0:
         raise ValueError("Block size must be an integer greater than zero")
         
-    return [block_from_bytes(byte_block) 
-            for byte_block in iter_blocks(by, block_size)]
+    view = memoryview(by)
+    return [block_from_bytes(view[i:i + block_size])
+            for i in range(0, len(view), block_size)]
     
 
 def bitlength(n: int) -> int:
@@ -158,6 +340,7 @@ def bitlength(n: int) -> int:
     return n.bit_length()
 
 
+@functools.lru_cache(maxsize=8)
 def compute_block_size(n: int) -> int:
     '''
     Computes the block size in bytes to be encrypted by RSA given the public
@@ -207,11 +390,119 @@ def compute_block_size(n: int) -> int:
     return quotient
 
 
+def _miller_rabin_round(w: int, b: int, a: int, m: int) -> bool:
+    '''
+    One round of Miller-Rabin for w with base b, where w - 1 = 2 ** a * m and
+    m is odd. Returns whether w is a strong probable prime to base b
+    '''
+    z = fast_power_mod(b, m, w)
+    if z == 1 or z == w - 1:
+        return True
+    i = 0
+    while i < a - 1 and z != 1:
+        z = fast_power_mod(z, 2, w)
+        if z == w - 1:
+            return True
+        i += 1
+    return False
+
+
+def jacobi(a: int, n: int) -> int:
+    '''
+    Computes the Jacobi symbol (a / n)
+
+    Parameters
+    ----------
+    a : int
+        Numerator
+    n : int
+        Denominator, an odd positive number
+
+    Returns
+    -------
+    int
+        1, -1 or 0
+    '''
+    a %= n
+    result = 1
+    while a != 0:
+        while a % 2 == 0:
+            a //= 2
+            if n % 8 in (3, 5):
+                result = -result
+        a, n = n, a
+        if a % 4 == 3 and n % 4 == 3:
+            result = -result
+        a %= n
+    return result if n == 1 else 0
+
+
+def strong_lucas(w: int) -> bool:
+    '''
+    Computes the strong Lucas probable prime test for w, with the parameters
+    P = 1 and Q = (1 - D) / 4 of Selfridge's method A.
+
+    Parameters
+    ----------
+    w : int
+        Odd number greater than 2 to be tested for primality.
+
+    Returns
+    -------
+    bool: whether w passes the test
+    '''
+    # There is no valid D for perfect squares
+    if math.isqrt(w) ** 2 == w:
+        return False
+    # First D in 5, -7, 9, -11, ... such that (D / w) = -1
+    D = 5
+    while True:
+        j = jacobi(D, w)
+        if j == -1:
+            break
+        if j == 0 and abs(D) != w:
+            return False
+        D = -D - 2 if D > 0 else -D + 2
+    P, Q = 1, (1 - D) // 4
+    
+    # w + 1 = 2 ** s * d, d odd
+    s = 0
+    d = w + 1
+    while d % 2 == 0:
+        s += 1
+        d //= 2
+    
+    # Compute U_d, V_d and Q ** d modulo w, from the most significant bit
+    U, V, Qk = 1, P, Q % w
+    for bit in bin(d)[3:]:
+        U, V = (U * V) % w, (V * V - 2 * Qk) % w
+        Qk = (Qk * Qk) % w
+        if bit == '1':
+            U, V = P * U + V, D * U + P * V
+            # Halve modulo w, w is odd
+            U = ((U + w) // 2 if U % 2 else U // 2) % w
+            V = ((V + w) // 2 if V % 2 else V // 2) % w
+            Qk = (Qk * Q) % w
+    
+    if U == 0 or V == 0:
+        return True
+    for _ in range(s - 1):
+        V = (V * V - 2 * Qk) % w
+        if V == 0:
+            return True
+        Qk = (Qk * Qk) % w
+    return False
+
+
 def miller_rabin(w: int, k: int = 10) -> bool:
     '''
     Computes the Miller-Rabin primality test for n. k is the number of rounds
     to be executed, a greater number increases the probability that n is actually
     prime is the test is positive.
+    
+    Before the random rounds, w goes through the Baillie-PSW test (a strong
+    test to base 2 followed by a strong Lucas test), so most composites are
+    discarded after one exponentiation.
 
     Parameters
     ----------
@@ -227,7 +518,7 @@ def miller_rabin(w: int, k: int = 10) -> bool:
     if w in [2, 3, 5, 7]:
         return True
     # If n is divisible by two do not bother with the algorithm: it is not prime
-    if w % 2 == 0:
+    if w < 2 or w % 2 == 0:
         return False
     a = 0
     m = w - 1
@@ -235,30 +526,31 @@ def miller_rabin(w: int, k: int = 10) -> bool:
         a += 1
         m //= 2
     
+    if gmpy2 is not None:
+        if not gmpy2.is_strong_bpsw_prp(w):
+            return False
+    elif not (_miller_rabin_round(w, 2, a, m) and strong_lucas(w)):
+        return False
+    
     wlen = bitlength(w)
     for _ in range(k):
         b = secrets.randbits(wlen)
         while b <= 1 or b >= w - 1:
             b = secrets.randbits(wlen)
-        z = power_mod(b, m, w)
-        if z == 1 or z == w - 1:
-            continue
-        i = 0
-        while i < a - 1 and z != 1:
-            z = power_mod(z, 2, w)
-            if z == w - 1:
-                break
-            i += 1
-        else:
+        if not _miller_rabin_round(w, b, a, m):
             return False
     return True
 
 
+@functools.lru_cache(maxsize=None)
 def estimate_k(bits: int, error : float = 2 ** -128) -> int:
     '''
     Compute the number of iterations of Miller-Rabin necessary to get a 
     probability of having a composite number with bits bits 
     passing the test lower than error.
+    
+    The inner sums over j and m do not depend on t, so they are accumulated
+    once instead of being recomputed for every (t, M) pair.
 
     Parameters
     ----------
@@ -275,23 +567,23 @@ def estimate_k(bits: int, error : float = 2 ** -128) -> int:
     '''
     max_t = math.ceil(- math.log2(error) / 2)
     max_m = math.floor(2 * math.sqrt(bits - 1) - 1)
+    first = Decimal(2.00743 * math.log(2) * bits) * pow(Decimal(2), -bits)
+    factor = (
+        Decimal(8 * (math.pi ** 2 - 6) / 3) * pow(Decimal(2), bits - 2)
+    )
+    
+    # inner[m] = sum of 1 / 2 ** (j + (bits - 1) / j) for j in [2, m]
+    inner = {}
+    acum = 0
+    for j in range(2, max_m):
+        acum += Decimal(1 / Decimal(2) ** Decimal(j + (bits - 1) / j))
+        inner[j] = acum
+    
     for t in range(1, max_t):
+        summatory = 0
         for M in range(3, max_m):
-            first = Decimal(2.00743 * math.log(2) * bits) * pow(Decimal(2), -bits)
-            summatory = sum(
-                (
-                    Decimal(2 ** (m - (m - 1) * t)) 
-                    * sum(
-                         Decimal(1 / Decimal(2) ** Decimal(j + (bits - 1) / j)) 
-                         for j in range(2, m + 1)
-                    )
-                 )
-                for m in range(3, M + 1)
-            )
+            summatory += Decimal(2 ** (M - (M - 1) * t)) * inner[M]
             summand = pow(Decimal(2), bits - 2 - M * t) 
-            factor = (
-                Decimal(8 * (math.pi ** 2 - 6) / 3) * pow(Decimal(2), bits - 2)
-            )
             
             estimate = first * (summand + factor * summatory)
             if estimate < error:
@@ -341,11 +633,64 @@ def random_number_range(low : int , high : int = None) -> Callable[[], int]:
     return lambda: (secrets.randbelow(high - low) + low)
 
 
+def has_small_factor(n: int) -> bool:
+    '''
+    Tests whether n is divisible by a prime lower than 2000, other than itself
+
+    Parameters
+    ----------
+    n : int
+        Number to be tested
+
+    Returns
+    -------
+    bool
+        True if n has a small prime factor, False otherwise
+    '''
+    if n < 2000:
+        return n not in _SMALL_PRIMES
+    return math.gcd(n, _SMALL_PRIMES_PRODUCT) != 1
+
+
+@functools.lru_cache(maxsize=8)
+def prime_factors(n: int) -> tuple[int, ...]:
+    '''
+    Computes the distinct prime factors of n by trial division, so it is only
+    practical for small numbers
+
+    Parameters
+    ----------
+    n : int
+        Number to be factored, greater than 0
+
+    Returns
+    -------
+    tuple[int, ...]
+        The prime factors of n, in increasing order
+    '''
+    factors = []
+    d = 2
+    while d * d <= n:
+        if n % d == 0:
+            factors.append(d)
+            while n % d == 0:
+                n //= d
+        d += 1 if d == 2 else 2
+    if n > 1:
+        factors.append(n)
+    return tuple(factors)
+
+
 def random_probable_prime(generator_func: Callable[[], int], k: int = 50, 
                           test_func: Callable[[int], bool] = None,
                           limit: int = 30000) -> int:
     '''
     Generate a random prime number with a set number of bits 
+    
+    If gmpy2 is available, each random number is used as the starting point
+    of gmpy2.next_prime, which finds the next probable prime (BPSW test) in C.
+    The prime is discarded if it has more bits than the random number.
+    Miller-Rabin is then only executed on primes that pass test_func.
 
     Parameters
     ----------
@@ -372,7 +717,19 @@ def random_probable_prime(generator_func: Callable[[], int], k: int = 50,
     while True:
         random_number = generator_func()
         
-        if test_func(random_number) and miller_rabin(random_number, k=k):
+        if gmpy2 is not None:
+            candidate = int(gmpy2.next_prime(random_number - 1))
+            if (
+                bitlength(candidate) == bitlength(random_number)
+                and test_func(candidate)
+                and miller_rabin(candidate, k=k)
+            ):
+                return candidate
+        elif (
+            not has_small_factor(random_number)
+            and test_func(random_number)
+            and miller_rabin(random_number, k=k)
+        ):
             return random_number
         if limit is not None:
             i += 1
@@ -407,34 +764,6 @@ def to_base_factors(original: int, base: int = 2 ** 8) -> list[int]:
         factors.insert(0, remainder)
     return factors
 
-def from_base_factors(factors: Iterable[int], base: int = 2 ** 8) -> int:
-    '''
-    Compute decimal value from coefficients located in factors in the selected
-    base.
-    
-    The result is an integer whose value is
-    factors[0] * base ** 0 + factors[1] * base ** 1, ..., factors[n] * base ** n
-
-    Parameters
-    ----------
-    factors : Iterable[int]
-        The coefficients in the base
-    base : int, optional
-        The base of the factors. The default is 2 ** 8.
-
-    Returns
-    -------
-    int
-        The decimal value
-
-    '''
-    total = 0
-    nfactors = len(factors)
-    for i, factor in enumerate(factors):
-        total += factor * base ** (nfactors - i - 1)
-    return total
-
-
 def bytes_from_block(block: int, blocksize : int = None) -> bytes:
     '''
     Extract the original bytes from a numeric block.
@@ -459,14 +788,14 @@ def bytes_from_block(block: int, blocksize : int = None) -> bytes:
     return bytes(factors)
 
 
-def block_from_bytes(byt: bytes) -> int:
+def block_from_bytes(byt: bytes | memoryview) -> int:
     '''
     Translate the bytes to a numeric value in base 2 ** 8.
-    Bytes are taken in little endian.
+    Bytes are taken in big endian.
     
     Parameters
     ----------
-    byt : bytes
+    byt : bytes | memoryview
         Bytes to transform
     base: 
     Returns
@@ -475,7 +804,7 @@ def block_from_bytes(byt: bytes) -> int:
         Numeric value of the bytes
 
     '''
-    return from_base_factors(byt, 2 ** 8)
+    return int.from_bytes(byt, byteorder="big")
 
 if __name__ == "__main__":
     by = b"\x00\x00\x01"
@@ -5,16 +5,28 @@ Created on Wed Nov  9 12:54:13 2022
 @author: David
 """
 import math
-from decimal import Decimal
 import warnings
 from funcs import (
-    blocks_from_bytes, power_mod, compute_block_size, bytes_from_block,
+    blocks_from_bytes, compute_block_size, bytes_from_block, power_mod_blocks,
+    power_mod_batches,
     estimate_k, bitlength, coprimes, random_probable_prime,
-    multiplicative_inverse, random_odd_number_nbits
+    multiplicative_inverse, random_odd_number_nbits, fast_power_mod
 )
 
+# Cache of the minimum prime value for each prime size
+_SQRT2_TABLE: dict[int, int] = {}
+
+def _min_prime(size: int) -> int:
+    '''
+    Smallest integer not lower than 2 ** (size - 1) * sqrt(2), computed
+    exactly as the integer square root of 2 ** (2 * size - 1)
+    '''
+    if size not in _SQRT2_TABLE:
+        _SQRT2_TABLE[size] = math.isqrt(2 ** (2 * size - 1)) + 1
+    return _SQRT2_TABLE[size]
+
 def rsa_keygen(nlen: int = 2048, e: int = 2 ** 16 + 1, tries : int = 30000
-               ) -> tuple[tuple[int, int], int]:
+               ) -> tuple[tuple[int, int], int, tuple[int, int, int, int, int]]:
     '''
     Compute public and private keys for RSA
 
@@ -32,8 +44,10 @@ def rsa_keygen(nlen: int = 2048, e: int = 2 ** 16 + 1, tries : int = 30000
 
     Returns
     -------
-    (n, e), d:
-        (n, e) is the public key and d the private key
+    (n, e), d, (p, q, dp, dq, qinv):
+        (n, e) is the public key and d the private key.
+        (p, q, dp, dq, qinv) are the CRT parameters of the private key,
+        dp = d mod (p - 1), dq = d mod (q - 1) and qinv = q ** -1 mod p
     '''
     # This is a particularity of our implementation, we will see why
     if nlen < 8:
@@ -52,14 +66,14 @@ def rsa_keygen(nlen: int = 2048, e: int = 2 ** 16 + 1, tries : int = 30000
     p_size = math.ceil(nlen / 2)
     q_size = nlen - p_size
     # Why these values?
-    min_p = Decimal(2 ** (p_size - 1)) * Decimal(2).sqrt()
-    min_q = Decimal(2 ** (q_size - 1)) * Decimal(2).sqrt()
+    min_p = _min_prime(p_size)
+    min_q = _min_prime(q_size)
     min_d = 2 ** (nlen // 2)
     p_q_diff = 2 ** (nlen // 2 - 100)
     
-    # Ensure we mimimize the probabilities of error in the primality test
-    #k = estimate_k(nlen, 2 ** - 128)
-    k = 12
+    # Ensure we mimimize the probabilities of error in the primality test.
+    # The tested numbers have at least q_size bits
+    k = estimate_k(q_size, 2 ** - 128)
     
     valid_d = False
     # d must not be too small and the number of bits of n must be exactly nlen
@@ -90,7 +104,12 @@ def rsa_keygen(nlen: int = 2048, e: int = 2 ** 16 + 1, tries : int = 30000
         
         # Check loop conditions
         valid_d = d > min_d
-    return (n, e), d
+
+    # Precomputed values for the CRT exponentiation with the private key
+    dp = d % (p - 1)
+    dq = d % (q - 1)
+    qinv = multiplicative_inverse(q, p)
+    return (n, e), d, (p, q, dp, dq, qinv)
 
 
 
@@ -117,8 +136,129 @@ def rsa_conversion(by: bytes, n: int, ex: int, extract_blocks_size: int
 
     '''
     blocks = blocks_from_bytes(by, extract_blocks_size)
-    return [power_mod(block, ex, n) for block in blocks]
+    return power_mod_blocks(blocks, ex, n)
+
+
+def rsa_conversion_crt(by: bytes, p: int, q: int, dp: int, dq: int, qinv: int,
+                       extract_blocks_size: int) -> list[int]:
+    '''
+    Executes RSA exponentiation with the private key on bytes and returns the
+    blocks, using the Chinese Remainder Theorem.
+
+    Each block is exponentiated modulo p and modulo q, with exponents half
+    the size of d, and both results are combined with Garner's formula.
+
+    Parameters
+    ----------
+    by : bytes
+        Message to be processed
+    p : int
+        First prime factor of n
+    q : int
+        Second prime factor of n
+    dp : int
+        d mod (p - 1)
+    dq : int
+        d mod (q - 1)
+    qinv : int
+        q ** -1 mod p
+    extract_blocks_size : int
+        Size of the blocks to be extracted from the message
+
+    Returns
+    -------
+    list[int]
+        Exponentiated blocks.
+
+    '''
+    blocks = blocks_from_bytes(by, extract_blocks_size)
+    # Both halves are computed together so that they share a pool of processes
+    listM1, listM2 = power_mod_batches([(blocks, dp, p), (blocks, dq, q)])
+    return [_garner(m1, m2, p, q, qinv) for m1, m2 in zip(listM1, listM2)]
+
+
+def _garner(m1: int, m2: int, p: int, q: int, qinv: int) -> int:
+    '''
+    Recover x mod p * q from m1 = x mod p and m2 = x mod q
+    '''
+    h = (qinv * (m1 - m2)) % p
+    return m2 + h * q
+
+
+def rsa_private_power(x: int, n: int, d: int,
+                      crt: tuple[int, int, int, int, int] = None) -> int:
+    '''
+    Compute (x ** d) % n for a single integer, using the Chinese Remainder
+    Theorem if the CRT parameters are available
+
+    Parameters
+    ----------
+    x : int
+        Number to be exponentiated, lower than n
+    n : int
+        Public modulus
+    d : int
+        Private exponent
+    crt : tuple[int, int, int, int, int], optional
+        (p, q, dp, dq, qinv) as returned by rsa_keygen. The default is None.
+
+    Returns
+    -------
+    int
+        (x ** d) % n
+    '''
+    if crt is None:
+        return fast_power_mod(x, d, n)
+    p, q, dp, dq, qinv = crt
+    return _garner(fast_power_mod(x, dp, p), fast_power_mod(x, dq, q),
+                   p, q, qinv)
+
+
+def _rsa_exponentiate(by: bytes, n: int, ex: int, extract_blocks_size: int,
+                      crt: tuple[int, int, int, int, int] = None
+                      ) -> list[int]:
+    '''
+    Dispatch to the CRT exponentiation if the private parameters are available
+    and to the plain one otherwise.
+    
+    The CRT parameters only describe the private exponent, so they are
+    rejected if they do not correspond to n and ex
+    '''
+    if crt is None:
+        return rsa_conversion(by, n, ex, extract_blocks_size)
+    p, q, dp, dq, _ = crt
+    if p * q != n or ex % (p - 1) != dp or ex % (q - 1) != dq:
+        raise ValueError("The CRT parameters do not correspond to the key")
+    return rsa_conversion_crt(by, *crt, extract_blocks_size)
+
+
+def _rsa_encode(by: bytes, n: int, ex: int,
+                crt: tuple[int, int, int, int, int] = None) -> bytes:
+    '''
+    Exponentiate the blocks of a message, followed by the size block, and
+    write them in the format read by rsa_decrypt
+    '''
+    block_size = compute_block_size(n)
+    encrypted_block_size = block_size + 1
+    
+    last_size = len(by) % block_size    
+    last_size = last_size or block_size
+    encrypted = _rsa_exponentiate(by, n, ex, block_size, crt)
+    
+    # We add an additional block with size of the last one.
+    # This is necessary to properly decrypt leading null bytes
+    padding_block = _rsa_exponentiate(
+        last_size.to_bytes(block_size, byteorder="big"), n, ex, block_size, crt)
+    encrypted += padding_block
     
+    # Write every block in a single preallocated buffer
+    out = bytearray(len(encrypted) * encrypted_block_size)
+    for i, block in enumerate(encrypted):
+        start = i * encrypted_block_size
+        out[start:start + encrypted_block_size] = block.to_bytes(
+            encrypted_block_size, byteorder="big")
+    return bytes(out)
+
 
 
 def rsa_encrypt(by: bytes, n: int, e: int) -> bytes:
@@ -138,27 +278,39 @@ def rsa_encrypt(by: bytes, n: int, e: int) -> bytes:
     bytes
         The encrypted message
     '''
-    block_size = compute_block_size(n)
-    encrypted_block_size = block_size + 1
-    
-    last_size = len(by) % block_size    
-    last_size = last_size or block_size
-    encrypted = rsa_conversion(by, n, e, block_size)
-    encrypted = [block.to_bytes(encrypted_block_size, byteorder="big") 
-                 for block in encrypted]
-    
-    # We add an additional block with size of the last one.
-    # This is necessary to properly decrypt leading null bytes
-    padding_block = rsa_conversion(
-        last_size.to_bytes(block_size, byteorder="big"), n, e, block_size)
-    padding_block = [block.to_bytes(encrypted_block_size, byteorder="big")
-                     for block in padding_block]
-    encrypted = (b'').join(encrypted + padding_block)
-    return encrypted
+    return _rsa_encode(by, n, e)
+
+
+
+def rsa_private_encrypt(by: bytes, n: int, d: int,
+                        crt: tuple[int, int, int, int, int] = None) -> bytes:
+    '''
+    Exponentiate a message with a private key, in the same format as
+    rsa_encrypt. This is the operation behind block signatures
+
+    Parameters
+    ----------
+    by : bytes
+        Message to process
+    n: int
+        Public modulus of the key owner
+    d : int
+        Private exponent of the key owner
+    crt : tuple[int, int, int, int, int], optional
+        (p, q, dp, dq, qinv) as returned by rsa_keygen. If given, they must
+        correspond to n and d and the Chinese Remainder Theorem is used.
+        The default is None.
+    Returns
+    -------
+    bytes
+        The processed message
+    '''
+    return _rsa_encode(by, n, d, crt)
 
 
 
-def rsa_decrypt(by: bytes, n: int, d: int) -> bytes:
+def rsa_decrypt(by: bytes, n: int, d: int,
+                crt: tuple[int, int, int, int, int] = None) -> bytes:
     '''
     Decrypt en encrypted message with RSA
 
@@ -170,6 +322,11 @@ def rsa_decrypt(by: bytes, n: int, d: int) -> bytes:
         Receiver public modulus
     d : int
         Receiver private key
+    crt : tuple[int, int, int, int, int], optional
+        (p, q, dp, dq, qinv) as returned by rsa_keygen. If given, they must
+        correspond to n and d and the decryption uses the Chinese Remainder
+        Theorem.
+        The default is None.
 
     Returns
     -------
@@ -178,7 +335,7 @@ def rsa_decrypt(by: bytes, n: int, d: int) -> bytes:
     '''
     encrypted_block_size = compute_block_size(n) + 1
     
-    decrypted = rsa_conversion(by, n, d, encrypted_block_size)
+    decrypted = _rsa_exponentiate(by, n, d, encrypted_block_size, crt)
     last_size = decrypted[-1]
     
     # decrypt the last block independently
@@ -193,7 +350,7 @@ def rsa_decrypt(by: bytes, n: int, d: int) -> bytes:
 
 
 if __name__ == "__main__":
-    (n, e), d = rsa_keygen(1024)
+    (n, e), d, crt = rsa_keygen(1024)
     #print("n:", n)
     #print("e:", e)
     #print("d:", d)
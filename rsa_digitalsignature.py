@@ -4,17 +4,19 @@
 # Verification: M = S^e mod n
 
 import hashlib
-from rsa import rsa_encrypt, rsa_decrypt
+import secrets
+from funcs import coprimes, multiplicative_inverse
+from rsa import rsa_encrypt, rsa_decrypt, rsa_private_encrypt, rsa_private_power
 
 # Select a hash function from FIPS 180-4
 # SHA-256 is the default
-def sha256(by: bytes) -> bytes:
+def sha256(by: bytes | memoryview) -> bytes:
     '''
     Computes the SHA-256 hash of a message
 
     Parameters
     ----------
-    by : bytes
+    by : bytes | memoryview
         Message to be hashed
 
     Returns
@@ -23,9 +25,10 @@ def sha256(by: bytes) -> bytes:
         SHA-256 hash of the message
 
     '''
-    return hashlib.sha256(by).digest()
+    return hashlib.sha256(memoryview(by)).digest()
 
-def rsa_sign(by: bytes, n: int, d: int) -> bytes:
+def rsa_sign(by: bytes, n: int, d: int,
+             crt: tuple[int, int, int, int, int] = None) -> bytes:
     '''
     Sign a message using RSA
 
@@ -37,6 +40,10 @@ def rsa_sign(by: bytes, n: int, d: int) -> bytes:
         Public modulus of receiver
     d : int
         Private exponent of receiver
+    crt : tuple[int, int, int, int, int], optional
+        (p, q, dp, dq, qinv) as returned by rsa_keygen. If given, the
+        signature is computed using the Chinese Remainder Theorem.
+        The default is None.
 
     Returns
     -------
@@ -44,7 +51,7 @@ def rsa_sign(by: bytes, n: int, d: int) -> bytes:
         The signature
 
     '''
-    return rsa_encrypt(by, n, d)
+    return rsa_private_encrypt(by, n, d, crt)
 
 def rsa_verify(by: bytes, n: int, e: int, signature: bytes) -> bool:
     '''
@@ -69,6 +76,87 @@ def rsa_verify(by: bytes, n: int, e: int, signature: bytes) -> bool:
     '''
     return rsa_decrypt(signature, n, e) == by
 
+def rsa_sign_hash(hashed: bytes, n: int, d: int, e: int,
+                  crt: tuple[int, int, int, int, int] = None) -> bytes:
+    '''
+    Sign a hash using RSA as a single integer, S = H^d mod n.
+    
+    Unlike rsa_sign, the hash is not split in blocks nor followed by a size
+    block, so signing needs just one exponentiation. The signature has the
+    byte length of n.
+    
+    The hash is blinded with a random r, (H * r^e)^d * r^-1 = H^d mod n, so
+    the time of the private exponentiation does not depend on H. The result
+    is checked with the public exponent before returning it, which detects
+    an e that does not match d and faults in the CRT computation.
+
+    Parameters
+    ----------
+    hashed : bytes
+        Hash of the message to sign. Its value must be lower than n
+    n: int
+        Public modulus of the signer
+    d : int
+        Private exponent of the signer
+    e : int
+        Public exponent of the signer
+    crt : tuple[int, int, int, int, int], optional
+        (p, q, dp, dq, qinv) as returned by rsa_keygen. If given, the
+        signature is computed using the Chinese Remainder Theorem.
+        The default is None.
+
+    Returns
+    -------
+    bytes
+        The signature
+
+    '''
+    h = int.from_bytes(hashed, byteorder="big")
+    if h >= n:
+        raise ValueError("The hash must be lower than the modulus n")
+    
+    r = secrets.randbelow(n - 2) + 2
+    while not coprimes(r, n):
+        r = secrets.randbelow(n - 2) + 2
+    blinded = (h * pow(r, e, n)) % n
+    
+    signature = rsa_private_power(blinded, n, d, crt)
+    signature = (signature * multiplicative_inverse(r, n)) % n
+    
+    if pow(signature, e, n) != h:
+        raise ValueError("The signature does not verify with the public exponent")
+    return signature.to_bytes((n.bit_length() + 7) // 8, byteorder="big")
+
+def rsa_verify_hash(hashed: bytes, n: int, e: int, signature: bytes) -> bool:
+    '''
+    Verify a signature generated by rsa_sign_hash, H = S^e mod n
+
+    Parameters
+    ----------
+    hashed : bytes
+        Hash of the message to verify
+    n: int
+        Public modulus of the signer
+    e : int
+        Public exponent of the signer
+    signature : bytes
+        Signature to verify
+
+    Returns
+    -------
+    bool
+        True if the signature is valid, False otherwise
+
+    '''
+    # Only the encoding produced by rsa_sign_hash is accepted, so that s + n
+    # or a zero-padded s do not also verify
+    if len(signature) != (n.bit_length() + 7) // 8:
+        return False
+    s = int.from_bytes(signature, byteorder="big")
+    if s >= n:
+        return False
+    return pow(s, e, n) == int.from_bytes(hashed, byteorder="big")
+
 
 if __name__ == "__main__":
     # My keys
@@ -94,6 +182,11 @@ if __name__ == "__main__":
     # Sign the message using my private key
     signature = rsa_sign(hashed_message, n, d)
     print("\nMy signature:", signature)
+
+    # Sign only the hash, as a single integer
+    hash_signature = rsa_sign_hash(hashed_message, n, d, e)
+    print("\nMy hash signature:", hash_signature)
+    print("Hash signature verified:", rsa_verify_hash(hashed_message, n, e, hash_signature))
     
     # ============================ RSA Signature Verification =============================== #
 
@@ -110,5 +203,5 @@ if __name__ == "__main__":
     print("\nDecrypted Bob's message:", decrypted_messageBob)
 
     # Verify the signature
-    verified = rsa_verify(sha256(rsa_decrypt(encrypted_messageBob, n, d)), n_, e_, signatureBob)
+    verified = rsa_verify(sha256(decrypted_messageBob), n_, e_, signatureBob)
     print("\nVerified:", verified)